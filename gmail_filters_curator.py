@@ -3,10 +3,11 @@
 import json
 import logging
 import os
-import xml.dom.minidom
-from typing import Dict, List
-from xml.dom.minidom import Element
+from operator import itemgetter
+from types import CodeType
+from typing import Any, Dict, List, Tuple
 from xml.etree import ElementTree
+from xml.etree.ElementTree import Element, TreeBuilder, XMLParser
 
 xml_default_namespace = 'http://www.w3.org/2005/Atom'
 xml_apps_namespace = 'http://schemas.google.com/apps/2006'
@@ -16,88 +17,120 @@ xml_namespaces_dict = {
     'apps': xml_apps_namespace,
 }
 
+for xml_namespace_prefix, xml_namespace_uri in xml_namespaces_dict.items():
+    ElementTree.register_namespace(xml_namespace_prefix, xml_namespace_uri)
+
 
 def get_xml_tag_with_namespace(namespace: str, tag: str) -> str:
-    return f'{{{namespace}}}{tag}'
+    return '{' + namespace + '}' + tag
+
+
+xml_entry_tag = get_xml_tag_with_namespace(xml_default_namespace, 'entry')
+xml_property_tag = get_xml_tag_with_namespace(xml_apps_namespace, 'property')
 
 
-def get_filter_entry_label(entry: ElementTree.Element) -> str:
+def get_filter_entry_label(entry: Element) -> str:
     label = ''
     for child in entry:
-        if child.tag == get_xml_tag_with_namespace(xml_apps_namespace, 'property'):
-            if child.attrib['name'] == 'label':
-                label = child.attrib['value']
-                break
+        if child.tag == xml_property_tag and child.get('name') == 'label':
+            label = child.get('value', '')
+            break
     assert len(label) > 0
     return label
 
 
-def sort_filter_entries_by_label(xml_root: Element) -> None:
-    filter_entries = xml_root.findall(get_xml_tag_with_namespace(xml_default_namespace, 'entry'))
-    filter_entries.sort(key=get_filter_entry_label)
-    for entry in filter_entries:
-        xml_root.remove(entry)
-        xml_root.append(entry)
+def sort_filter_entries_by_label(xml_root: Element, labelled_entries: List[Tuple[str, Element]]) -> None:
+    labelled_entries.sort(key=itemgetter(0))
+    other_elements = [child for child in xml_root if child.tag != xml_entry_tag]
+    xml_root[:] = other_elements + [entry for _, entry in labelled_entries]
+
+
+def compile_assertion(assertion: str, rule_name: str) -> Tuple[str, CodeType]:
+    return assertion, compile(assertion, f'<rule {rule_name}>', 'eval')
+
 
+def compile_filter_rules(filter_rules: Dict[str, Any]) -> Dict[str, Any]:
+    compiled_rules = {}
+    for tag, rule in filter_rules.items():
+        if isinstance(rule, dict):
+            compiled_rules[tag] = {name: compile_assertion(assertion, name) for name, assertion in rule.items()}
+        else:
+            compiled_rules[tag] = compile_assertion(rule, tag)
+    return compiled_rules
 
-def check_filter_entity_properties(xml_root: Element, rules_json_path: str) -> None:
+
+def read_filter_rules(rules_json_path: str) -> Dict[str, Any]:
     with open(rules_json_path) as rules_file:
         json_filter_file = json.loads(rules_file.read())
 
     filter_rules = json_filter_file['rules']
-    labels_to_ignore = json_filter_file['ignored labels']
-    xml_filter_entries = xml_root.findall(get_xml_tag_with_namespace(xml_default_namespace, 'entry'))
-    
-    for xml_entry in xml_filter_entries:
-        encountered_elements = set()
-        encountered_properties = set()
-        label = get_filter_entry_label(xml_entry)
-        if label in labels_to_ignore:
-            logging.info(f'Ignoring: {label}')
-            continue
-        logging.debug(f'Checking: {label}')
-        for element in xml_entry:
-            encountered_elements.add(element.tag)
-            assert element.tag in filter_rules
-            json_rule_element = filter_rules[element.tag]
-            if isinstance(json_rule_element, dict):
-                attribute_name = element.attrib['name']
-                assert attribute_name in json_rule_element
-                encountered_properties.add(attribute_name)
-                assertion = json_rule_element[attribute_name]
-            else:
-                assertion = json_rule_element
-
-            eval_result = eval(assertion)
-            assert eval_result, f'Issue with filter for label {label}. Assertion failed: {assertion}'
-
-        expected_elements = set(filter_rules.keys())
-        expected_properties = set(filter_rules[get_xml_tag_with_namespace(xml_apps_namespace, 'property')].keys())
-        unexpected_elements = encountered_elements - expected_elements
-        unexpected_properties = encountered_properties - expected_properties
-        missing_elements = expected_elements - encountered_elements
-        missing_properties = expected_properties - encountered_properties
-        assert not unexpected_elements
-        assert not unexpected_properties
-        assert not missing_elements
-        assert not missing_properties
-
-
-def get_xml_root(xml_file: str, xml_namespaces: Dict[str, str]) -> Element:
-    for prefix, uri in xml_namespaces.items():
-        ElementTree.register_namespace(prefix, uri)
-
-    xml_tree = ElementTree.parse(xml_file)
-    return xml_tree.getroot()
+    return {
+        'rules': compile_filter_rules(filter_rules),
+        'ignored labels': frozenset(json_filter_file['ignored labels']),
+        'expected elements': frozenset(filter_rules),
+        'expected properties': frozenset(filter_rules[xml_property_tag]),
+    }
+
+
+def check_filter_entry_properties(xml_entry: Element, filter_rules: Dict[str, Any]) -> str:
+    compiled_rules = filter_rules['rules']
+    expected_elements = filter_rules['expected elements']
+    expected_properties = filter_rules['expected properties']
+    encountered_elements = set()
+    encountered_properties = set()
+    label = get_filter_entry_label(xml_entry)
+    if label in filter_rules['ignored labels']:
+        logging.info(f'Ignoring: {label}')
+        return label
+    logging.debug(f'Checking: {label}')
+    for element in xml_entry:
+        encountered_elements.add(element.tag)
+        rule = compiled_rules.get(element.tag)
+        assert rule is not None
+        if isinstance(rule, dict):
+            attribute_name = element.get('name')
+            rule = rule.get(attribute_name)
+            assert rule is not None
+            encountered_properties.add(attribute_name)
+        assertion, compiled_assertion = rule
+
+        eval_result = eval(compiled_assertion, {'element': element, 'label': label})
+        assert eval_result, f'Issue with filter for label {label}. Assertion failed: {assertion}'
+
+    unexpected_elements = encountered_elements - expected_elements
+    unexpected_properties = encountered_properties - expected_properties
+    missing_elements = expected_elements - encountered_elements
+    missing_properties = expected_properties - encountered_properties
+    assert not unexpected_elements
+    assert not unexpected_properties
+    assert not missing_elements
+    assert not missing_properties
+    return label
+
+
+def get_checked_xml_root(xml_file: str, filter_rules: Dict[str, Any]) -> Tuple[Element, List[Tuple[str, Element]]]:
+    entry_tag = xml_entry_tag
+    check_entry = check_filter_entry_properties
+    xml_root = ElementTree.parse(xml_file, parser=XMLParser(target=TreeBuilder())).getroot()
+    labelled_entries = []
+    for element in xml_root:
+        if element.tag == entry_tag:
+            label = check_entry(element, filter_rules)
+            labelled_entries.append((label, element))
+    return xml_root, labelled_entries
 
 
 def write_xml_root(xml_root: Element, output_path: str) -> None:
-    xml_string = ElementTree.tostring(xml_root)
-    xml_dom = xml.dom.minidom.parseString(xml_string)
-    xml_pretty_str = xml_dom.toprettyxml(encoding='UTF-8').decode('UTF-8')
-    xml_pretty_str = os.linesep.join([s for s in xml_pretty_str.splitlines() if s.strip()])
-    with open(output_path, 'wb') as text_file:
-        text_file.write(xml_pretty_str.encode('UTF-8'))
+    # Match the layout minidom.toprettyxml produced so sorted exports kept under version control stay stable.
+    ElementTree.indent(xml_root, space='\t')
+    xml_bytes = ElementTree.tostring(xml_root, encoding='UTF-8', xml_declaration=False).replace(b' />', b'/>')
+    xml_declaration = b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    if os.linesep != '\n':
+        xml_declaration = xml_declaration.replace(b'\n', os.linesep.encode('UTF-8'))
+        xml_bytes = xml_bytes.replace(b'\n', os.linesep.encode('UTF-8'))
+    with open(output_path, 'wb', buffering=1 << 20) as xml_file:
+        xml_file.write(xml_declaration)
+        xml_file.write(xml_bytes)
 
 
 def parse_args(args: List[str]) -> Dict[str, str]:
@@ -138,9 +171,9 @@ def main(args: List[str]) -> None:
     output_filter_xml_path = args_dict['outFile']
     rules_json_path = args_dict['rulesFile']
 
-    xml_root = get_xml_root(input_filter_xml_path, xml_namespaces_dict)
-    check_filter_entity_properties(xml_root, rules_json_path)
-    sort_filter_entries_by_label(xml_root)
+    filter_rules = read_filter_rules(rules_json_path)
+    xml_root, labelled_entries = get_checked_xml_root(input_filter_xml_path, filter_rules)
+    sort_filter_entries_by_label(xml_root, labelled_entries)
     write_xml_root(xml_root, output_filter_xml_path)
 
     logging.info('The script has completed successfully.')